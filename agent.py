@@ -2,10 +2,20 @@ import os
 import json
 import re
 import glob
+import mmap
+import io
+import sqlite3
+import tempfile
+import time
+import asyncio
+import threading
+import functools
+import atexit
+from collections import deque
+import httpx
+import openai
 from dotenv import load_dotenv
 
-from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai import ChatOpenAI
 
 from langchain_core.prompts import (
@@ -14,6 +24,21 @@ from langchain_core.prompts import (
     HumanMessagePromptTemplate
 )
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.rate_limiters import InMemoryRateLimiter
+import tiktoken
+import xxhash
+from lxml import etree
+
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so handlers are unchanged
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
 
 load_dotenv()
 
@@ -27,6 +52,20 @@ raw_key = os.getenv("OPENROUTER_API_KEY")
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
 STORED_FILES_DIR = "stored_files"
 PROJECTS_INDEX = os.path.join("databases", "projects.json")
+MMAP_THRESHOLD = 64 * 1024
+# Above this many characters the selector list is trimmed per test case
+SELECTOR_MAP_BUDGET = 4000
+RETRIEVAL_CACHE_FILE = "retrieval_cache.json"
+RETRIEVAL_CACHE_SIZE = 256
+LLM_CACHE_PATH = os.path.join("databases", "llm_cache.sqlite")
+# Cosine similarity at or above which a near-duplicate request reuses a cached response
+LLM_CACHE_MIN_SIMILARITY = 0.97
+
+LLM_MODEL = "meta-llama/llama-3.1-8b-instruct"
+
+# OpenRouter limits for the model in get_llm()
+LLM_REQUESTS_PER_MINUTE = 30
+LLM_TOKENS_PER_MINUTE = 60000
 
 if raw_key:
     OPENROUTER_API_KEY = raw_key.strip().strip('"').strip("'")
@@ -35,30 +74,294 @@ if raw_key:
     os.environ["OPENAI_API_URL"] = "https://openrouter.ai/api/v1"
     os.environ["OPENROUTER_API_KEY"] = OPENROUTER_API_KEY
 
-embedding_function = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+# Heavy vector-store / embedding deps are imported on first use so the module
+# itself stays cheap to import (e.g. for clean_python_code or Streamlit reloads)
+_embedding_function = None
+_embedding_lock = threading.Lock()
+
+def get_embedding_function():
+    global _embedding_function
+    if _embedding_function is None:
+        # Concurrent first callers (to_thread retrievals) must not load the model twice
+        with _embedding_lock:
+            if _embedding_function is None:
+                from embeddings import FastEmbedEmbeddings
+                _embedding_function = FastEmbedEmbeddings(model_name=EMBEDDING_MODEL, batch_size=64)
+    return _embedding_function
+
+_preload_lock = threading.Lock()
+_preload_thread = None
+
+def preload():
+    # Warm the embedding model and LLM client in the background so the first
+    # request doesn't pay for them; cheap no-op on every later call
+    global _preload_thread
+    with _preload_lock:
+        if _preload_thread is None:
+            _preload_thread = threading.Thread(
+                target=lambda: (get_embedding_function(), get_llm()),
+                daemon=True
+            )
+            _preload_thread.start()
+
+# Parsed projects.json, re-read only when the backend rewrites the file
+_index_cache = {"key": None, "data": None}
+
+def _projects_index_key():
+    st = os.stat(PROJECTS_INDEX)
+    return (st.st_mtime_ns, st.st_size)
 
 def load_db_info(db_id):
-    with open(PROJECTS_INDEX, "r", encoding="utf-8") as f:
-        index = json.load(f)
-    return index.get(db_id)
+    key = _projects_index_key()
+    if _index_cache["key"] != key:
+        with open(PROJECTS_INDEX, "rb") as f:
+            _index_cache.update(key=key, data=json_loads(f.read()))
+    return _index_cache["data"].get(db_id)
+
+def db_errors():
+    # Evaluated only on the error path, so chromadb stays a lazy import
+    from chromadb.errors import ChromaError
+    return (OSError, KeyError, json.JSONDecodeError, ChromaError)
+
+# Transient LLM failures the caller should retry instead of getting an error string
+RETRYABLE_LLM_ERRORS = (openai.RateLimitError, openai.APIConnectionError, httpx.HTTPError)
+
+# Open Chroma handles by db_id; the HNSW index stays warm between calls.
+# Callers share the handle and must not mutate the collection.
+_chroma_cache = {}
+_chroma_lock = threading.Lock()
+CHROMA_CACHE_SIZE = 8
 
 def load_chroma(db_id):
+    from langchain_chroma import Chroma
+
+    with _chroma_lock:
+        if db_id in _chroma_cache:
+            return _chroma_cache[db_id]
+        info = load_db_info(db_id)
+        if info is None:
+            raise KeyError(f"Unknown db_id: {db_id}")
+        persist_dir = info["persist_dir"]
+        db = Chroma(persist_directory=persist_dir, embedding_function=get_embedding_function())
+        if len(_chroma_cache) >= CHROMA_CACHE_SIZE:
+            _chroma_cache.pop(next(iter(_chroma_cache)))
+        _chroma_cache[db_id] = db
+        return db
+
+# db_ids whose load_chroma failed; skipped until projects.json changes
+_bad_dbs = {"key": None, "ids": set()}
+
+def is_bad_db(db_id):
+    try:
+        key = _projects_index_key()
+    except OSError:
+        key = None
+    if _bad_dbs["key"] != key:
+        _bad_dbs.update(key=key, ids=set())
+    return db_id in _bad_dbs["ids"]
+
+def mark_bad_db(db_id):
+    _bad_dbs["ids"].add(db_id)
+
+def invalidate_chroma(db_id):
+    # Call after re-indexing a DB so the next load_chroma reopens it
+    with _chroma_lock:
+        _chroma_cache.pop(db_id, None)
+    _bad_dbs["ids"].discard(db_id)
+    clear_retrieval_cache(db_id)
+
+# (query, k) -> ((page_content, source), ...) per db_id, mirrored to a JSON
+# file in the DB's persist dir so repeated queries skip the embedding + ANN search.
+# Retrieval runs on worker threads, so every access goes through the lock.
+_retrieval_caches = {}
+_retrieval_lock = threading.Lock()
+
+def _retrieval_cache_path(db_id):
     info = load_db_info(db_id)
-    persist_dir = info["persist_dir"]
-    return Chroma(persist_directory=persist_dir, embedding_function=embedding_function)
+    if info is None:
+        raise KeyError(f"Unknown db_id: {db_id}")
+    return os.path.join(info["persist_dir"], RETRIEVAL_CACHE_FILE)
+
+def _load_retrieval_cache_file(path):
+    # Missing, truncated or malformed files just start an empty cache
+    try:
+        with open(path, "rb") as f:
+            entries = json_loads(f.read())
+        return {(query, k): tuple(tuple(doc) for doc in docs) for query, k, docs in entries}
+    except (OSError, ValueError, TypeError):
+        return {}
+
+def _get_retrieval_cache(db_id):
+    # Caller holds _retrieval_lock
+    if db_id not in _retrieval_caches:
+        _retrieval_caches[db_id] = _load_retrieval_cache_file(_retrieval_cache_path(db_id))
+    return _retrieval_caches[db_id]
+
+def _save_retrieval_cache(db_id, cache):
+    # Caller holds _retrieval_lock; the unique temp file also keeps other
+    # processes writing the same DB's cache from clobbering each other
+    path = _retrieval_cache_path(db_id)
+    data = json_dumps([[query, k, docs] for (query, k), docs in cache.items()])
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def normalize_query(query):
+    # MiniLM is uncased and ignores spacing, so these variants embed identically
+    return " ".join(query.split()).lower()
+
+def similarity_search_cached(db_id, query, k):
+    query = normalize_query(query)
+    key = (query, k)
+    with _retrieval_lock:
+        cache = _get_retrieval_cache(db_id)
+        if key in cache:
+            return cache[key]
+    # The search itself runs unlocked so concurrent misses still overlap
+    results = load_chroma(db_id).similarity_search(query, k=k)
+    docs = tuple(
+        (doc.page_content, doc.metadata.get("source", "Unknown")) for doc in results
+    )
+    with _retrieval_lock:
+        cache = _get_retrieval_cache(db_id)
+        if key not in cache and len(cache) >= RETRIEVAL_CACHE_SIZE:
+            cache.pop(next(iter(cache)))
+        cache[key] = docs
+        try:
+            _save_retrieval_cache(db_id, cache)
+        except OSError:
+            # Best effort: a read-only or full persist dir only loses the
+            # on-disk copy, never the search result
+            pass
+    return docs
+
+def clear_retrieval_cache(db_id):
+    # Call after a DB is re-indexed so stale hits are not served
+    with _retrieval_lock:
+        _retrieval_caches.pop(db_id, None)
+        try:
+            os.remove(_retrieval_cache_path(db_id))
+        except (OSError, KeyError):
+            pass
 
+# Shared by every get_llm() instance so the RPM budget is global to the process
+rate_limiter = InMemoryRateLimiter(
+    requests_per_second=LLM_REQUESTS_PER_MINUTE / 60,
+    check_every_n_seconds=0.1,
+    max_bucket_size=10
+)
+
+_token_encoding = None
+_token_window = deque()
+_token_lock = threading.Lock()
+
+def count_tokens(text):
+    # cl100k is only an approximation for Llama anyway. Its BPE file is
+    # downloaded on first use, so when that host is unreachable (offline,
+    # proxy) fall back to ~4 chars per token rather than fail the LLM call
+    global _token_encoding
+    if _token_encoding is None:
+        try:
+            _token_encoding = tiktoken.get_encoding("cl100k_base")
+        except (OSError, ValueError):
+            _token_encoding = False
+    if _token_encoding is False:
+        return len(text) // 4
+    return len(_token_encoding.encode(text))
+
+async def wait_for_token_budget(prompt_text):
+    # Sleep until the prompt fits in the rolling one-minute TPM window
+    tokens = count_tokens(prompt_text)
+    while True:
+        with _token_lock:
+            now = time.monotonic()
+            while _token_window and now - _token_window[0][0] >= 60:
+                _token_window.popleft()
+            used = sum(n for _, n in _token_window)
+            if not _token_window or used + tokens <= LLM_TOKENS_PER_MINUTE:
+                _token_window.append((now, tokens))
+                return tokens
+            wait = 60 - (now - _token_window[0][0])
+        await asyncio.sleep(wait)
+
+# One long-lived event loop for all agent coroutines. The shared async HTTP
+# pool below is bound to the loop it first runs on, so per-call asyncio.run()
+# loops would leave it with dead connections.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="agent-loop", daemon=True).start()
+    return _loop
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
+
+# Keep-alive + HTTP/2 pools shared by every ChatOpenAI instance
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+http_client = httpx.Client(http2=True, limits=HTTP_LIMITS)
+http_async_client = httpx.AsyncClient(http2=True, limits=HTTP_LIMITS)
+
+def _close_http_clients():
+    http_client.close()
+    if _loop is not None:
+        asyncio.run_coroutine_threadsafe(http_async_client.aclose(), _loop).result(timeout=5)
+
+atexit.register(_close_http_clients)
+
+# Model, key and headers are fixed for the process, so one client (and its
+# validated config + pooled connections) serves every call
+@functools.lru_cache(maxsize=1)
 def get_llm():
     return ChatOpenAI(
-        model="meta-llama/llama-3.1-8b-instruct",
+        model=LLM_MODEL,
         openai_api_key=os.environ["OPENROUTER_API_KEY"],
         openai_api_base="https://openrouter.ai/api/v1",
         temperature=0,
+        rate_limiter=rate_limiter,
+        http_client=http_client,
+        http_async_client=http_async_client,
         default_headers={
             "HTTP-Referer": "http://localhost:8501",
             "X-Title": "OceanAI Agent"
         }
     )
 
+def content_hash(data):
+    # Internal cache keys only; xxh3 is non-cryptographic but SIMD-fast on large HTML.
+    # Accepts str or any bytes-like buffer (bytes, mmap) without copying the latter.
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return xxhash.xxh3_128_hexdigest(data)
+
+def _ingest_html(data):
+    # Hash and selector analysis run on the raw bytes (ASCII-only patterns),
+    # so the only full-document str made is the final decode
+    html_hash = content_hash(data)
+    analyze_html_cached(data, html_hash)
+    return str(data, "utf-8"), html_hash
+
+def read_html_file(full_path):
+    # Returns (content, content hash) and primes analyze_html_cached for this version
+    with open(full_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= MMAP_THRESHOLD:
+            return _ingest_html(f.read())
+        # Large files: work straight off the shared page-cache mapping,
+        # skipping the intermediate bytes copy a buffered read would make
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return _ingest_html(mm)
+
+_html_file_cache = {"key": None, "content": None, "hash": None}
+
 def get_stored_html_details():
     if not os.path.exists(STORED_FILES_DIR):
         return None, None, None
@@ -68,12 +371,60 @@ def get_stored_html_details():
     full_path = files[0]
     filename = os.path.basename(full_path)
     try:
-        with open(full_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        return full_path, filename, content
-    except:
+        # Unchanged file (same path, mtime and size) -> no re-read, no re-hash
+        st = os.stat(full_path)
+        key = (full_path, st.st_mtime_ns, st.st_size)
+        if _html_file_cache["key"] != key:
+            content, html_hash = read_html_file(full_path)
+            _html_file_cache.update(key=key, content=content, hash=html_hash)
+        return full_path, filename, _html_file_cache["content"]
+    except (OSError, UnicodeDecodeError):
         return None, None, None
 
+def html_content_hash(html_content):
+    if html_content is _html_file_cache["content"]:
+        return _html_file_cache["hash"]
+    return content_hash(html_content)
+
+# Selectors the system prompt gives a fixed semantic role; never trimmed
+ALWAYS_INCLUDE_SELECTORS = {
+    "product-card", "cart-summary", "discount-code", "discount-group", "subtotal",
+    "discount-amount", "shipping-cost", "total-price", "checkout-form",
+    "fullname", "email", "address", "pay-btn"
+}
+_SELECTOR_NAME_RE = re.compile(r'[#.]([\w-]+)')
+_WORD_RE = re.compile(r'[a-z0-9]+')
+
+def budget_selector_map(selector_map, test_case_text, max_chars=SELECTOR_MAP_BUDGET):
+    # Small maps go through untouched, so the system prompt stays identical
+    # across test cases (prompt-cache friendly); large ones keep only the
+    # selectors the test case plausibly touches
+    if len(selector_map) <= max_chars:
+        return selector_map
+    words = set(_WORD_RE.findall(test_case_text.lower()))
+    kept = []
+    for line in selector_map.split("\n"):
+        match = _SELECTOR_NAME_RE.search(line)
+        name = match.group(1) if match else ""
+        if (
+            line.startswith("BUTTON:")
+            or name in ALWAYS_INCLUDE_SELECTORS
+            or words.intersection(_WORD_RE.findall(name.lower()))
+        ):
+            kept.append(line)
+    trimmed = "\n".join(kept)
+    # The prompt allows ONLY listed selectors, so a filter that matched (next
+    # to) nothing must not leave the list empty; fall back to the page order
+    if len(trimmed) < max_chars // 4:
+        trimmed = selector_map
+    if len(trimmed) > max_chars:
+        cut = trimmed.rfind("\n", 0, max_chars + 1)
+        trimmed = trimmed[:cut] if cut > 0 else trimmed[:max_chars]
+    return trimmed
+
+# Backslashes that don't start a valid JSON escape
+_JSON_ESC_RE = re.compile(r'\\(?![\\/\"bfnrtu])')
+
 def clean_and_parse_json(ai_output):
     try:
         text = ai_output.replace("```json", "").replace("```", "")
@@ -85,9 +436,11 @@ def clean_and_parse_json(ai_output):
         if start == -1 or end == 0:
             return {"error": "No JSON found"}
         json_str = text[start:end]
-        json_str = re.sub(r'\\(?![\\/\"bfnrtu])', '/', json_str)
-        return json.loads(json_str)
-    except:
+        # Clean LLM JSON usually has no backslashes at all; skip the regex pass then
+        if "\\" in json_str:
+            json_str = _JSON_ESC_RE.sub('/', json_str)
+        return json_loads(json_str)
+    except json.JSONDecodeError:
         return {"error": "JSON parse error", "raw": ai_output}
 
 def clean_python_code(ai_output):
@@ -96,65 +449,291 @@ def clean_python_code(ai_output):
         code = code[code.find("import os"):]
     return code.strip()
 
-def extract_selectors(html_content):
-    ids = re.findall(r'id="([^"]+)"', html_content)
-    classes = re.findall(r'class="([^"]+)"', html_content)
-
-    # Flatten class list (split multi-class entries)
-    class_list = []
-    for c in classes:
-        class_list.extend(c.split())
-
-    buttons = re.findall(r'<button[^>]*>', html_content)
-    inputs = re.findall(r'<input[^>]*>', html_content)
-    textareas = re.findall(r'<textarea[^>]*>', html_content)
-
-    selector_doc = []
-
-    # Add IDs
-    for i in ids:
-        selector_doc.append(f"ID: #{i}")
-
-    # Add classes
-    for c in class_list:
-        selector_doc.append(f"CLASS: .{c}")
-
-    # Add buttons with context
-    for btn in buttons:
-        if 'class="' in btn:
-            cls = re.findall(r'class="([^"]+)"', btn)[0].split()[0]
-            selector_doc.append(f"BUTTON: .{cls} button")
-        else:
-            selector_doc.append("BUTTON: <button> (no class)")
-
-    # Add inputs
-    for inp in inputs:
-        id_match = re.findall(r'id="([^"]+)"', inp)
-        if id_match:
-            selector_doc.append(f"INPUT: #{id_match[0]}")
-
-    # Add textareas
-    for ta in textareas:
-        id_match = re.findall(r'id="([^"]+)"', ta)
-        if id_match:
-            selector_doc.append(f"TEXTAREA: #{id_match[0]}")
+def _strip_fences(text):
+    return text.replace("```python", "").replace("```", "")
+
+# A trailing backtick run, optionally followed by the start of "python", may
+# still become a fence once more text arrives
+_FENCE_TAIL_RE = re.compile(r'`+(?:p(?:y(?:t(?:h(?:o)?)?)?)?)?\Z')
+
+async def clean_python_code_stream(chunks):
+    """Streaming counterpart of clean_python_code; the concatenated output is identical."""
+    raw = ""
+    sent = ""
+    async for chunk in chunks:
+        raw += chunk
+        # Re-clean the whole buffer minus its unsettled tail: piecewise fence
+        # stripping diverges from one pass over long backtick runs. Backticks
+        # left at the end can still join later ones, and trailing whitespace
+        # only survives the final strip if more code follows, so both wait.
+        tail = _FENCE_TAIL_RE.search(raw)
+        code = _strip_fences(raw[:tail.start()] if tail else raw)
+        start = code.find("import os")
+        if start == -1:
+            continue
+        ready = code[start:].rstrip(" \t\r\n\f\v`")
+        if len(ready) > len(sent):
+            yield ready[len(sent):]
+            sent = ready
+
+    rest = clean_python_code(raw)[len(sent):]
+    if rest:
+        yield rest
+
+# One scan of the document: tag branch for button/input/textarea (whose own
+# attributes are then parsed from the short captured segment), plus bare
+# id/class attributes everywhere else
+_TAG_RE = re.compile(r'<(button|input|textarea)([^>]*)>|id="([^"]+)"|class="([^"]+)"')
+_ATTR_RE = re.compile(r'(id|class)="([^"]+)"')
+_TAG_RE_BYTES = re.compile(_TAG_RE.pattern.encode())
+
+def _tag_matches(html_content):
+    if isinstance(html_content, str):
+        return _TAG_RE.findall(html_content)
+    # bytes / mmap: scan without decoding the document, decode only the captures
+    return [
+        tuple(group.decode("utf-8", "replace") for group in match)
+        for match in _TAG_RE_BYTES.findall(html_content)
+    ]
 
+def extract_selectors(html_content):
+    # dicts as insertion-ordered sets: each selector is listed once, in
+    # document order, which keeps the prompt small and deterministic
+    ids = {}
+    class_names = {}
+    buttons = {}
+    inputs = {}
+    textareas = {}
+
+    for tag, attrs, el_id, classes in _tag_matches(html_content):
+        if not tag:
+            if el_id:
+                ids[el_id] = None
+            else:
+                class_names.update(dict.fromkeys(classes.split()))
+            continue
+
+        tag_id = tag_classes = None
+        for name, value in _ATTR_RE.findall(attrs):
+            if name == "id":
+                ids[value] = None
+                tag_id = tag_id or value
+            else:
+                tokens = value.split()
+                class_names.update(dict.fromkeys(tokens))
+                tag_classes = tag_classes or tokens
+
+        if tag == "button":
+            if tag_classes:
+                buttons[f"BUTTON: .{tag_classes[0]} button"] = None
+            else:
+                buttons["BUTTON: <button> (no class)"] = None
+        elif tag_id and tag == "input":
+            inputs[f"INPUT: #{tag_id}"] = None
+        elif tag_id:
+            textareas[f"TEXTAREA: #{tag_id}"] = None
+
+    selector_doc = [f"ID: #{i}" for i in ids]
+    selector_doc.extend(f"CLASS: .{c}" for c in class_names)
+    selector_doc.extend(buttons)
+    selector_doc.extend(inputs)
+    selector_doc.extend(textareas)
     return "\n".join(selector_doc)
 
 
+def build_selector_inventory(html_content):
+    # Single streaming pass over the markup; only the structural subset the
+    # LLM needs is kept, never a full tree
+    inventory = {"hidden_ids": [], "forms": []}
+    form = None
+    if isinstance(html_content, str):
+        source = io.BytesIO(html_content.encode("utf-8"))
+    elif isinstance(html_content, bytes):
+        source = io.BytesIO(html_content)
+    else:
+        # mmap: lxml reads it like a file, no copy of the document
+        html_content.seek(0)
+        source = html_content
+    try:
+        events = etree.iterparse(
+            source,
+            events=("start", "end"),
+            html=True,
+            recover=True
+        )
+        for event, el in events:
+            if not isinstance(el.tag, str):
+                continue
+            if event == "end":
+                if el.tag == "form":
+                    form = None
+                # Drop finished elements and their already-seen siblings so
+                # memory stays flat however long the page is
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+                continue
+
+            el_id = el.get("id")
+            style = (el.get("style") or "").replace(" ", "").lower()
+            if el_id and (
+                "display:none" in style
+                or el.get("hidden") is not None
+                or el.get("aria-hidden") == "true"
+            ):
+                inventory["hidden_ids"].append(el_id)
+
+            if el.tag == "form":
+                form = {"id": el_id, "fields": []}
+                inventory["forms"].append(form)
+            elif form is not None and el.tag in ("input", "select", "textarea", "button"):
+                field = el_id or el.get("name")
+                if field and field not in form["fields"]:
+                    form["fields"].append(field)
+    except etree.LxmlError:
+        pass
+    return inventory
+
+def _structure_json(inventory):
+    # ids/classes reach the prompt via selector_map; the inventory only holds
+    # the structure the map can't express
+    if not inventory["hidden_ids"] and not inventory["forms"]:
+        return "{}"
+    return json.dumps(inventory)
+
+_html_analysis_cache = {}
+
+def analyze_html_cached(html_content, html_hash):
+    # (selector_map, selector_inventory JSON) per HTML version, so N test
+    # cases against one file scan the markup once instead of N times
+    if html_hash not in _html_analysis_cache:
+        if len(_html_analysis_cache) >= 8:
+            _html_analysis_cache.pop(next(iter(_html_analysis_cache)))
+        _html_analysis_cache[html_hash] = (
+            extract_selectors(html_content),
+            _structure_json(build_selector_inventory(html_content))
+        )
+    return _html_analysis_cache[html_hash]
+
+
 def generate_test_cases(db_id, query):
+    return run_async(agenerate_test_cases(db_id, query))
+
+
+# LLM response cache: exact match on the rendered prompt first, then cosine
+# similarity between embeddings of the request's variable text (query, or
+# test case title + description) within the same scope (same retrieved
+# context / same HTML). The full prompt is not embedded: its static prefix
+# would dominate MiniLM's 256-token window and make everything look alike.
+_llm_cache_conn = None
+_llm_cache_lock = threading.Lock()
+
+def _get_llm_cache():
+    global _llm_cache_conn
+    if _llm_cache_conn is None:
+        os.makedirs(os.path.dirname(LLM_CACHE_PATH), exist_ok=True)
+        conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False)
+        # WAL lets concurrent Streamlit sessions read while one writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            "key TEXT PRIMARY KEY, scope TEXT NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_scope ON llm_cache (scope)")
+        _llm_cache_conn = conn
+    return _llm_cache_conn
+
+def prompt_version(*templates):
+    # Part of every cache scope, so editing a prompt or switching models never
+    # serves semantic hits produced by the old version
+    return content_hash("\0".join((LLM_MODEL,) + templates))
+
+def llm_cache_lookup(prompt_text, semantic_text, scope):
+    # Returns (cached response or None, key, embedding) - key/embedding feed llm_cache_store
+    import numpy as np
+
+    key = content_hash(prompt_text)
+    with _llm_cache_lock:
+        row = _get_llm_cache().execute(
+            "SELECT response FROM llm_cache WHERE key = ?", (key,)
+        ).fetchone()
+    if row:
+        return row[0], key, None
+
+    # The semantic tier is an optimization only: any failure in it (model
+    # download, ONNX runtime, numpy shape) is a miss, never a failed generation
+    try:
+        embedding = np.asarray(get_embedding_function().embed_query(semantic_text), dtype=np.float32)
+        with _llm_cache_lock:
+            rows = _get_llm_cache().execute(
+                "SELECT embedding, response FROM llm_cache WHERE scope = ?", (scope,)
+            ).fetchall()
+        # Rows embedded by a different model have another width; skip them
+        rows = [r for r in rows if r[0] is not None and len(r[0]) == embedding.nbytes]
+        if rows:
+            matrix = np.frombuffer(b"".join(r[0] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+            sims = matrix @ embedding / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(embedding) + 1e-12)
+            best = int(np.argmax(sims))
+            if sims[best] >= LLM_CACHE_MIN_SIMILARITY:
+                return rows[best][1], key, embedding
+    except Exception:
+        return None, key, None
+    return None, key, embedding
+
+def llm_cache_store(key, scope, embedding, response):
+    with _llm_cache_lock:
+        conn = _get_llm_cache()
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_cache (key, scope, embedding, response) VALUES (?, ?, ?, ?)",
+            (key, scope, embedding.tobytes(), response)
+        )
+        conn.commit()
+
+async def cached_llm_lookup(prompt_text, semantic_text, scope):
+    try:
+        return await asyncio.to_thread(llm_cache_lookup, prompt_text, semantic_text, scope)
+    except (sqlite3.Error, OSError):
+        return None, None, None
+
+async def cached_llm_store(key, scope, embedding, response):
+    if key is None or embedding is None:
+        return
+    try:
+        await asyncio.to_thread(llm_cache_store, key, scope, embedding, response)
+    except (sqlite3.Error, OSError):
+        pass
+
+
+def retrieve_docs(db_id, query, k):
+    if is_bad_db(db_id):
+        return None
+    # Only a DB that can't be opened is remembered as bad; a failed search
+    # on an open DB is reported for this call alone
     try:
-        db = load_chroma(db_id)
-    except:
+        load_chroma(db_id)
+    except db_errors():
+        mark_bad_db(db_id)
+        return None
+    try:
+        return similarity_search_cached(db_id, query, k)
+    except db_errors():
+        return None
+
+
+async def agenerate_test_cases(db_id, query):
+    # Retrieval (embed + ANN search) and LLM client setup are independent
+    results, llm = await asyncio.gather(
+        asyncio.to_thread(retrieve_docs, db_id, query, 6),
+        asyncio.to_thread(get_llm)
+    )
+    if results is None:
         return {"error": "DB not found"}
 
-    results = db.similarity_search(query, k=6)
     context_text = "\n\n".join([
-        f"Source: {doc.metadata.get('source', 'Unknown')}\nContent: {doc.page_content}" 
-        for doc in results
+        f"Source: {source}\nContent: {content}" 
+        for content, source in results
     ])
 
-    llm = get_llm()
     prompt = ChatPromptTemplate.from_template(
         """
 You are a Senior QA Lead.
@@ -235,35 +814,32 @@ REQUIREMENTS ABOUT NEWLINES:
     )
 
     chain = prompt | llm | StrOutputParser()
-    raw = chain.invoke({"context": context_text, "query": query})
-    return clean_and_parse_json(raw)
+    inputs = {"context": context_text, "query": query}
+    prompt_text = prompt.format(**inputs)
 
-def generate_selenium_script(db_id, selected_test_case):
-    html_path, html_filename, html_content = get_stored_html_details()
-    selector_map = extract_selectors(html_content)
+    scope = f"test_cases:{prompt_version(prompt.template)}:{db_id}:{content_hash(context_text)}"
+    cached, cache_key, cache_embedding = await cached_llm_lookup(prompt_text, query, scope)
+    if cached is not None:
+        return clean_and_parse_json(cached)
 
-    if not html_content:
-        return "# No HTML found."
+    await wait_for_token_budget(prompt_text)
+    raw = await chain.ainvoke(inputs)
+    parsed = clean_and_parse_json(raw)
+    # Unparseable output is not cached so "Generate" again gets a fresh answer
+    if not (isinstance(parsed, dict) and "error" in parsed):
+        await cached_llm_store(cache_key, scope, cache_embedding, raw)
+    return parsed
 
-    try:
-        db = load_chroma(db_id)
-        q = f"{selected_test_case.get('title')} {selected_test_case.get('description')}"
-        results = db.similarity_search(q, k=3)
-        context_text = "\n".join([doc.page_content for doc in results])
-    except:
-        context_text = ""
-
-    llm = get_llm()
-    system_template = """
+
+SELENIUM_SYSTEM_TEMPLATE = """
 You are a Senior QA Automation Engineer who generates Selenium Python scripts that EXACTLY match the real HTML structure provided. Give only code no extra explaination
 Dont hallucinate elements or selectors from HTML code, read every detail and remember and apply the context with only selectors or class names present.
 Check what will happen if that step is included in final code, and i need code in order dont mix up.
 Dont create full process but understand the where to start and where to end based on test case steps dont over do, Create code until i get output not over coding logic.
 You must read:
 1. The TEST CASE (steps + expected behavior)
-2. The FULL HTML CODE
-3. The EXACT list of VALID SELECTORS extracted from that HTML:  
-{selector_map}
+2. The HTML STRUCTURE (hidden elements and forms with their fields)
+3. The EXACT list of VALID SELECTORS extracted from that HTML (listed once, below)
 
 Your job is to:
 - Follow do or dont of steps in test cases.
@@ -278,14 +854,14 @@ Your job is to:
 ===============================================================
 
 1. **You MUST NOT invent selectors. EVER.**
-   You may ONLY use selectors listed in `{selector_map}`.
+   You may ONLY use selectors listed under VALID SELECTORS.
    If a required selector is NOT in this list:
      → STOP and return an error message.
 
 2. **If a test step uses a selector not found in HTML:**
    - DO NOT guess.
    - DO NOT create.
-   - FIX it to the closest REAL selector from `{selector_map}` ONLY IF that selector represents the same element.
+   - FIX it to the closest REAL selector from VALID SELECTORS ONLY IF that selector represents the same element.
    - If no match exists → STOP and output an error.
 
 3. **Selector Format Rules (MANDATORY):**
@@ -298,7 +874,7 @@ Your job is to:
    - INVALID (never output):
        "#id.class"
        ".class1.class2"
-       Any selector not found in {selector_map}
+       Any selector not found in VALID SELECTORS
 
 4. **You must understand the HTML flow from the code:**
    - `.product-card button` adds an item to the cart.
@@ -382,7 +958,7 @@ Your job is to:
 - The script MUST strictly follow the template provided in the user message
 - The block “# --- GENERATED LOGIC STARTS HERE ---” must contain ONLY working Selenium actions
 
-If any required HTML element **does not exist** according to selector_map → output:
+If any required HTML element **does not exist** according to VALID SELECTORS → output:
 
     ERROR: Missing required HTML element "<selector_name>"
 
@@ -394,18 +970,19 @@ END OF SYSTEM INSTRUCTIONS — NOW FOLLOW THE USER TEMPLATE
 
 """
 
-
-    user_template = """
+# HTML first: everything up to the test case is identical across calls for
+# the same file, which keeps the provider-side prompt cache prefix long
+SELENIUM_USER_TEMPLATE = """
+    TARGET HTML FILE: {filename}
+    TARGET HTML STRUCTURE (JSON):
+    {selector_inventory}
+    
     TEST CASE DETAILS:
     ID: {id}
     Title: {title}
     Steps: {steps}
     Expected: {expected_result}
     
-    TARGET HTML FILE: {filename}
-    TARGET HTML CONTENT:
-    {html_code}
-    
     Use full template instead of generating half code.
     ------------------------------------------------
     GENERATE THE PYTHON SCRIPT USING THIS SKELETON:
@@ -491,23 +1068,148 @@ END OF SYSTEM INSTRUCTIONS — NOW FOLLOW THE USER TEMPLATE
         run_test()
     """
 
-    prompt = ChatPromptTemplate.from_messages([
-        SystemMessagePromptTemplate.from_template(system_template),
-        HumanMessagePromptTemplate.from_template(user_template)
+SELENIUM_PROMPT = ChatPromptTemplate.from_messages([
+    SystemMessagePromptTemplate.from_template(SELENIUM_SYSTEM_TEMPLATE),
+    HumanMessagePromptTemplate.from_template(SELENIUM_USER_TEMPLATE)
+])
+SELENIUM_PROMPT_VERSION = prompt_version(SELENIUM_SYSTEM_TEMPLATE, SELENIUM_USER_TEMPLATE)
+
+
+def generate_selenium_script(db_id, selected_test_case):
+    return run_async(agenerate_selenium_script(db_id, selected_test_case))
+
+
+def generate_selenium_script_stream(db_id, selected_test_case):
+    # Sync generator over the async stream, for Streamlit's script thread
+    chunks = agenerate_selenium_script_stream(db_id, selected_test_case)
+    try:
+        while True:
+            try:
+                yield run_async(chunks.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        run_async(chunks.aclose())
+
+
+async def agenerate_selenium_script(db_id, selected_test_case):
+    return "".join([
+        chunk async for chunk in agenerate_selenium_script_stream(db_id, selected_test_case)
     ])
 
+
+def load_selenium_html_context():
+    # Per-HTML work shared by every test case generated against the stored file
+    html_path, html_filename, html_content = get_stored_html_details()
+    if not html_content:
+        return None
+    html_hash = html_content_hash(html_content)
+    selector_map, selector_inventory = analyze_html_cached(html_content, html_hash)
+    return {
+        "filename": html_filename,
+        "html_hash": html_hash,
+        "selector_map": selector_map,
+        "selector_inventory": selector_inventory
+    }
+
+
+def generate_selenium_scripts_batch(db_id, test_cases):
+    return run_async(agenerate_selenium_scripts_batch(db_id, test_cases))
+
+
+async def agenerate_selenium_scripts_batch(db_id, test_cases, max_concurrency=8):
+    # HTML prep and the LLM client are built once; the per-test-case LLM calls
+    # then overlap, capped to stay inside OpenRouter's concurrency limits
+    html_context, llm = await asyncio.gather(
+        asyncio.to_thread(load_selenium_html_context),
+        asyncio.to_thread(get_llm)
+    )
+    if html_context is None:
+        return ["# No HTML found."] * len(test_cases)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def generate_one(test_case):
+        async with semaphore:
+            try:
+                return "".join([
+                    chunk async for chunk in agenerate_selenium_script_stream(
+                        db_id, test_case, html_context=html_context, llm=llm
+                    )
+                ])
+            except RETRYABLE_LLM_ERRORS as e:
+                return f"# Error: {e}"
+
+    return await asyncio.gather(*[generate_one(tc) for tc in test_cases])
+
+
+async def agenerate_selenium_script_stream(db_id, selected_test_case, html_context=None, llm=None):
+    async def _given(value):
+        return value
+
+    # HTML file I/O and LLM client setup are independent, run whichever
+    # still need doing side by side. The Selenium prompt takes no knowledge
+    # base context, so no Chroma lookup is made here.
+    html_context, llm = await asyncio.gather(
+        _given(html_context) if html_context is not None
+        else asyncio.to_thread(load_selenium_html_context),
+        _given(llm) if llm is not None else asyncio.to_thread(get_llm)
+    )
+
+    if html_context is None:
+        yield "# No HTML found."
+        return
+
+    prompt = SELENIUM_PROMPT
     chain = prompt | llm | StrOutputParser()
 
+    html_hash = html_context["html_hash"]
+    test_case_text = " ".join(
+        str(selected_test_case.get(field) or "")
+        for field in ("title", "description", "steps", "expected_result")
+    )
+    inputs = {
+        "id": selected_test_case.get("id"),
+        "title": selected_test_case.get("title"),
+        "steps": selected_test_case.get("steps"),
+        "expected_result": selected_test_case.get("expected_result"),
+        "selector_inventory": html_context["selector_inventory"],
+        "filename": html_context["filename"],
+        "selector_map": budget_selector_map(html_context["selector_map"], test_case_text)
+    }
+
+    prompt_text = prompt.format(**inputs)
+
+    # Only the same test case (the script prints its ID) against the same HTML
+    # may reuse an earlier script; similarity is judged on what drives the
+    # script, not the description the prompt never sees
+    steps = selected_test_case.get("steps")
+    if isinstance(steps, list):
+        steps = " ".join(str(step) for step in steps)
+    semantic_text = " ".join(
+        str(part or "")
+        for part in (selected_test_case.get("title"), steps, selected_test_case.get("expected_result"))
+    )
+    scope = f"selenium:{SELENIUM_PROMPT_VERSION}:{html_hash}:{selected_test_case.get('id')}"
+    cached, cache_key, cache_embedding = await cached_llm_lookup(prompt_text, semantic_text, scope)
+    if cached is not None:
+        yield cached
+        return
+
     try:
-        raw = chain.invoke({
-            "id": selected_test_case.get("id"),
-            "title": selected_test_case.get("title"),
-            "steps": selected_test_case.get("steps"),
-            "expected_result": selected_test_case.get("expected_result"),
-            "html_code": html_content,
-            "filename": html_filename,
-            "selector_map": selector_map
-        })
-        return clean_python_code(raw)
+        await wait_for_token_budget(prompt_text)
+        generated = []
+        async for code_chunk in clean_python_code_stream(chain.astream(inputs)):
+            generated.append(code_chunk)
+            yield code_chunk
+    except RETRYABLE_LLM_ERRORS:
+        raise
     except Exception as e:
-        return f"# Error: {e}"
+        # Joined by the non-streaming callers: keep the partial code intact
+        # and put the error on its own line
+        yield f"\n# Error: {e}" if generated else f"# Error: {e}"
+        return
+
+    script = "".join(generated)
+    if not script.startswith("ERROR"):
+        await cached_llm_store(cache_key, scope, cache_embedding, script)
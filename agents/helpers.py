@@ -5,7 +5,7 @@ import glob
 from dotenv import load_dotenv
 
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+from embeddings import FastEmbedEmbeddings
 from langchain_openai import ChatOpenAI
 
 # --- Configuration & Setup ---
@@ -29,7 +29,7 @@ if raw_key:
     os.environ["OPENAI_API_URL"] = "https://openrouter.ai/api/v1"
     os.environ["OPENROUTER_API_KEY"] = OPENROUTER_API_KEY
 
-embedding_function = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+embedding_function = FastEmbedEmbeddings(model_name=EMBEDDING_MODEL)
 
 # --- Helper Functions ---
 
@@ -1,14 +1,19 @@
 import os
-import json
 import requests
 import streamlit as st
-from agent import generate_test_cases, generate_selenium_script
+from agent import (
+    generate_test_cases,
+    generate_selenium_script_stream,
+    generate_selenium_scripts_batch,
+    preload
+)
 
 BACKEND_URL = "http://127.0.0.1:8000"
 # Path of the uploaded HTML file available in the environment (provided to assistant)
 LOCAL_HTML_PATH = "/mnt/data/44f69aee-a339-48e3-853c-0ebabea98a94.html"
 
 st.set_page_config(page_title="QA Agent", layout="wide")
+preload()
 st.title("🤖 Autonomous QA Agent")
 
 if "test_plan" not in st.session_state:
@@ -135,7 +140,11 @@ with tab2:
 
         if st.button("🔍 Generate Plan"):
             with st.spinner("Thinking..."):
-                result = generate_test_cases(st.session_state.selected_db, user_query)
+                try:
+                    result = generate_test_cases(st.session_state.selected_db, user_query)
+                except Exception as e:
+                    # rate limits / network errors surface here after the client's own retries
+                    result = {"error": f"LLM Error: {e}"}
 
                 if isinstance(result, dict) and "error" in result:
                     st.error(result["error"])
@@ -182,25 +191,35 @@ with tab3:
         )
 
         if st.button("⚡ Generate Selenium Code"):
+            st.subheader("Generated Script")
+            code_box = st.empty()
             with st.spinner("Generating..."):
-                code = generate_selenium_script(
-                    st.session_state.selected_db,
-                    selected_tc
-                )
-
-                # 🔹 Normalize `code` to a plain string
-                if isinstance(code, bytes):
-                    code = code.decode("utf-8", errors="ignore")
-
-                if isinstance(code, dict):
-                    code = (
-                        code.get("script")
-                        or code.get("code")
-                        or json.dumps(code, indent=2)
-                    )
+                # render the script progressively as the LLM streams it
+                code = ""
+                try:
+                    for chunk in generate_selenium_script_stream(
+                        st.session_state.selected_db,
+                        selected_tc
+                    ):
+                        code += chunk
+                        code_box.code(code, language="python")
+                except Exception as e:
+                    code = f"# LLM Error: {e}"
 
-                if not isinstance(code, str):
-                    code = str(code)
+                code_box.code(code, language="python")
+
+        if st.button("⚡ Generate All Scripts"):
+            with st.spinner(f"Generating {len(st.session_state.test_plan)} scripts..."):
+                # one batched call: the LLM requests run concurrently
+                try:
+                    scripts = generate_selenium_scripts_batch(
+                        st.session_state.selected_db,
+                        st.session_state.test_plan
+                    )
+                except Exception as e:
+                    scripts = [f"# LLM Error: {e}"] * len(st.session_state.test_plan)
 
-                st.subheader("Generated Script")
-                st.code(code, language="python")
+            st.subheader("Generated Scripts")
+            for tc, script in zip(st.session_state.test_plan, scripts):
+                with st.expander(format_func(tc)):
+                    st.code(script, language="python")
@@ -0,0 +1,17 @@
+from fastembed import TextEmbedding
+from langchain_core.embeddings import Embeddings
+
+
+class FastEmbedEmbeddings(Embeddings):
+    """LangChain embeddings backed by FastEmbed's ONNX Runtime models (no torch)."""
+
+    def __init__(self, model_name, batch_size=64):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = TextEmbedding(model_name)
+
+    def embed_documents(self, texts):
+        return [vector.tolist() for vector in self.model.embed(texts, batch_size=self.batch_size)]
+
+    def embed_query(self, text):
+        return list(self.model.embed([text]))[0].tolist()
@@ -3,6 +3,7 @@ import os
 import shutil
 import uuid
 import json
+import threading
 from datetime import datetime
 from typing import List, Optional
 
@@ -10,8 +11,8 @@ from fastapi import FastAPI, UploadFile, File, HTTPException
 from pydantic import BaseModel
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, UnstructuredMarkdownLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
+from embeddings import FastEmbedEmbeddings
 import uvicorn
 
 # -----------------------
@@ -35,7 +36,11 @@ os.makedirs(STORED_FILES_PATH, exist_ok=True)
 os.makedirs(TEMP_FILES_PATH, exist_ok=True)
 
 # Initialize Embeddings (single instance per process)
-embedding_function = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+embedding_function = FastEmbedEmbeddings(model_name=EMBEDDING_MODEL)
+
+# Open vectorstores by persist_dir, reused across /query calls
+_vectorstores = {}
+_vectorstores_lock = threading.Lock()
 
 # FastAPI app
 app = FastAPI(title="QA Agent Backend - multi-db per upload")
@@ -56,6 +61,12 @@ def _save_projects_index(index: dict):
     with open(PROJECTS_INDEX, "w", encoding="utf-8") as f:
         json.dump(index, f, indent=2)
 
+def get_vectorstore(persist_dir: str) -> Chroma:
+    with _vectorstores_lock:
+        if persist_dir not in _vectorstores:
+            _vectorstores[persist_dir] = Chroma(persist_directory=persist_dir, embedding_function=embedding_function)
+        return _vectorstores[persist_dir]
+
 def register_db_entry(display_name: str, persist_dir: str, extra: Optional[dict] = None):
     index = _load_projects_index()
     db_id = "db_" + uuid.uuid4().hex[:12]
@@ -250,6 +261,8 @@ def delete_database(db_id: str):
         raise HTTPException(status_code=404, detail="DB not found")
 
     persist_dir = entry["persist_dir"]
+    with _vectorstores_lock:
+        _vectorstores.pop(persist_dir, None)
     # remove folder
     try:
         if os.path.exists(persist_dir):
@@ -276,8 +289,8 @@ def query_database(req: QueryRequest):
         raise HTTPException(status_code=404, detail="DB persist directory not found on disk")
 
     try:
-        # Recreate a Chroma vectorstore instance pointing to that persist directory
-        vectorstore = Chroma(persist_directory=persist_dir, embedding_function=embedding_function)
+        # Reuse the Chroma vectorstore opened for that persist directory
+        vectorstore = get_vectorstore(persist_dir)
         # similarity_search is provided by LangChain VectorStore interface
         results = vectorstore.similarity_search(req.query, k=req.top_k or 5)
 